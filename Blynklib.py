@@ -6,6 +6,7 @@ import struct
 import time
 import sys
 import os
+import errno
  
 try:
     import machine
@@ -13,8 +14,19 @@ try:
     SOCK_TIMEOUT = 0
 except ImportError:
     const = lambda x: x
-    gettime = lambda: int(time.time() * 1000)
-    SOCK_TIMEOUT = 0.05
+    # Monotonic: NTP steps of the wall clock must not trip the heartbeat
+    _monotonic_ns = time.monotonic_ns
+    gettime = lambda: _monotonic_ns() // 1000000
+    SOCK_TIMEOUT = None  # per connection: one heartbeat, see Blynk.connect
+ 
+# Blynk frame header: command, message id, payload length
+try:
+    _HDR = struct.Struct("!BHH")
+except AttributeError:
+    # MicroPython's struct has no Struct, fall back to the module functions
+    class _HDR:
+        pack = staticmethod(lambda *a: struct.pack("!BHH", *a))
+        unpack_from = staticmethod(lambda buf, off=0: struct.unpack_from("!BHH", buf, off))
  
 def dummy(*args):
     pass
@@ -83,6 +95,13 @@ class BlynkProtocol(EventEmitter):
     def virtual_write(self, pin, *val):
         self._send(MSG_HW, 'vw', pin, *val)
  
+    def virtual_write_many(self, pairs):
+        # Several (pin, value) updates sent as one write on the socket
+        msg = b''.join([self._frame(MSG_HW, 'vw', pin, val) for pin, val in pairs])
+        if msg:
+            self.lastSend = gettime()
+            self._write(msg)
+ 
     def send_internal(self, pin, *val):
         self._send(MSG_INTERNAL,  pin, *val)
  
@@ -95,7 +114,7 @@ class BlynkProtocol(EventEmitter):
     def log_event(self, *val):
         self._send(MSG_EVENT_LOG, *val)
  
-    def _send(self, cmd, *args, **kwargs):
+    def _frame(self, cmd, *args, **kwargs):
         if 'id' in kwargs:
             id = kwargs.get('id')
         else:
@@ -107,12 +126,19 @@ class BlynkProtocol(EventEmitter):
         if cmd == MSG_RSP:
             data = b''
             dlen = args[0]
+        elif not args:
+            # MSG_PING and other bare commands: nothing to encode
+            data = b''
+            dlen = 0
         else:
             data = ('\0'.join(map(str, args))).encode('utf8')
             dlen = len(data)
         
         self.log('<', cmd, id, '|', *args)
-        msg = struct.pack("!BHH", cmd, id, dlen) + data
+        return _HDR.pack(cmd, id, dlen) + data
+ 
+    def _send(self, cmd, *args, **kwargs):
+        msg = self._frame(cmd, *args, **kwargs)
         self.lastSend = gettime()
         self._write(msg)
  
@@ -120,13 +146,15 @@ class BlynkProtocol(EventEmitter):
         if self.state != DISCONNECTED: return
         self.msg_id = 1
         (self.lastRecv, self.lastSend, self.lastPing) = (gettime(), 0, 0)
-        self.bin = b""
+        self.bin = bytearray()
+        self._off = 0
         self.state = CONNECTING
         self._send(MSG_HW_LOGIN, self.auth)
  
     def disconnect(self):
         if self.state == DISCONNECTED: return
-        self.bin = b""
+        self.bin = bytearray()
+        self._off = 0
         self.state = DISCONNECTED
         self.emit('disconnected')
  
@@ -141,19 +169,19 @@ class BlynkProtocol(EventEmitter):
             self._send(MSG_PING)
             self.lastPing = now
         
-        if data != None and len(data):
-            self.bin += data
+        if data:
+            self.bin.extend(data)
  
         while True:
-            if len(self.bin) < 5:
+            if len(self.bin) - self._off < 5:
                 break
  
-            cmd, i, dlen = struct.unpack("!BHH", self.bin[:5])
+            cmd, i, dlen = _HDR.unpack_from(self.bin, self._off)
             if i == 0: return self.disconnect()
                       
             self.lastRecv = now
             if cmd == MSG_RSP:
-                self.bin = self.bin[5:]
+                self._off += 5
  
                 self.log('>', cmd, i, '|', dlen)
                 if self.state == CONNECTING and i == 1:
@@ -181,18 +209,23 @@ class BlynkProtocol(EventEmitter):
                     print("Cmd too big: ", dlen)
                     return self.disconnect()
  
-                if len(self.bin) < 5+dlen:
+                if len(self.bin) - self._off < 5+dlen:
                     break
  
-                data = self.bin[5:5+dlen]
-                self.bin = self.bin[5+dlen:]
+                if cmd == MSG_PING:
+                    # Payload is unused, answer without copying or decoding it
+                    self._off += 5+dlen
+                    self.log('>', cmd, i, '|')
+                    self._send(MSG_RSP, STA_SUCCESS, id=i)
+                    continue
+ 
+                data = bytes(self.bin[self._off+5:self._off+5+dlen])
+                self._off += 5+dlen
  
-                args = list(map(lambda x: x.decode('utf8'), data.split(b'\0')))
+                args = [x.decode('utf8') for x in data.split(b'\0')]
  
                 self.log('>', cmd, i, '|', ','.join(args))
-                if cmd == MSG_PING:
-                    self._send(MSG_RSP, STA_SUCCESS, id=i)
-                elif cmd == MSG_HW or cmd == MSG_BRIDGE:
+                if cmd == MSG_HW or cmd == MSG_BRIDGE:
                     if args[0] == 'vw':
                         self.emit("V"+args[1], args[2:])
                         self.emit("V*", args[1], args[2:])
@@ -204,44 +237,86 @@ class BlynkProtocol(EventEmitter):
                     print("Unexpected command: ", cmd)
                     return self.disconnect()
  
+        # Drop consumed frames only once they dominate the buffer
+        if self._off > 4096 or self._off*2 > len(self.bin):
+            # Slice copy, not del: MicroPython bytearrays lack slice deletion
+            self.bin = self.bin[self._off:]
+            self._off = 0
+ 
 import socket
+import select
+ 
+# Built once: loading the trust store is slow on small boards
+try:
+    import ussl
+    _SSL_CTX = ussl
+except ImportError:
+    import ssl
+    _SSL_CTX = ssl.create_default_context()
  
 class Blynk(BlynkProtocol):
     def __init__(self, auth, **kwargs):
         self.insecure = kwargs.pop('insecure', False)
         self.server = kwargs.pop('server', 'blynk.cloud')
         self.port = kwargs.pop('port', 80 if self.insecure else 443)
+        self._ssl_ctx = _SSL_CTX
+        self._cached_addr = None
         BlynkProtocol.__init__(self, auth, **kwargs)
+        self._rxbuf = bytearray(self.buffin)
+        self._rxmv = memoryview(self._rxbuf)
         self.on('redirect', self.redirect)
  
     def redirect(self, server, port):
         self.server = server
         self.port = port
+        self._cached_addr = None
         self.disconnect()
         self.connect()
  
+    def _resolve(self):
+        try:
+            socket.inet_pton(socket.AF_INET, self.server)
+            return (self.server, self.port)  # already an IP, no DNS needed
+        except (OSError, AttributeError):
+            pass
+        try:
+            self._cached_addr = socket.getaddrinfo(self.server, self.port,
+                                                   socket.AF_INET, socket.SOCK_STREAM)[0][-1]
+        except OSError:
+            if self._cached_addr is None:
+                raise
+            print('DNS lookup failed, reusing %s:%d' % self._cached_addr)
+        return self._cached_addr
+ 
     def connect(self):
         print('Connecting to %s:%d...' % (self.server, self.port))
         s = socket.socket()
-        s.connect(socket.getaddrinfo(self.server, self.port)[0][-1])
+        s.connect(self._resolve())
         try:
             s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         except:
             pass
+        try:
+            # Let the kernel drop a dead path: probe after 30s idle, 3 misses 10s apart
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        except:
+            pass
         if self.insecure:
             self.conn = s
         else:
-            try:
-                import ussl
-                ssl_context = ussl
-            except ImportError:
-                import ssl
-                ssl_context = ssl.create_default_context()
-            self.conn = ssl_context.wrap_socket(s, server_hostname=self.server)
+            self.conn = self._ssl_ctx.wrap_socket(s, server_hostname=self.server)
+        # Idle waiting happens in select(); this only bounds a read stalled
+        # mid TLS record or a blocked write, so the heartbeat watchdog still runs
+        timeout = self.heartbeat / 1000 if SOCK_TIMEOUT is None else SOCK_TIMEOUT
         try:
-            self.conn.settimeout(SOCK_TIMEOUT)
+            self.conn.settimeout(timeout)
         except:
-            s.settimeout(SOCK_TIMEOUT)
+            s.settimeout(timeout)
+        # MicroPython streams (ussl, socket) only offer readinto
+        self._recv_into = getattr(self.conn, 'recv_into', None) or self.conn.readinto
         BlynkProtocol.connect(self)
  
     def _write(self, data):
@@ -249,16 +324,43 @@ class Blynk(BlynkProtocol):
         self.conn.write(data)
         # TODO: handle disconnect
  
+    def _wait_readable(self):
+        # TLS may hold already-decrypted bytes that select() cannot see
+        pending = getattr(self.conn, 'pending', None)  # CPython SSLSocket only
+        if pending and pending():
+            return True
+        # Sleep in the kernel until data arrives or a ping could be due
+        due = max(self.lastPing + self.heartbeat//10,
+                  min(self.lastSend, self.lastRecv) + self.heartbeat)
+        timeout = max(0.1, (due - gettime()) / 1000)
+        r, _, _ = select.select([self.conn], [], [], timeout)
+        return bool(r)
+ 
     def run(self):
-        data = b''
+        if self.state == DISCONNECTED:
+            # Nothing to wait on; let the caller back off and reconnect
+            raise OSError(errno.ENOTCONN, 'Blynk is disconnected')
+        readable = False
+        n = 0
         try:
-            data = self.conn.read(self.buffin)
-            #print('>', data)
+            readable = self._wait_readable()
+            if readable:
+                n = self._recv_into(self._rxmv)
+                if n is None:
+                    # Non-blocking MicroPython stream with no full record yet
+                    readable, n = False, 0
+            #print('>', self._rxmv[:n])
         except KeyboardInterrupt:
             raise
         except socket.timeout:
-            # No data received, call process to send ping messages when needed
-            pass
+            # Record never completed, call process so the heartbeat check can disconnect
+            readable, n = False, 0
         except: # TODO: handle disconnect
             return
-        self.process(data)
+        if readable and n == 0:
+            # Peer closed the connection; select() would report it readable forever
+            self.conn.close()
+            self.disconnect()
+            raise OSError(errno.ECONNRESET, 'Blynk server closed the connection')
+        # No data means select() timed out: process still sends pings when due
+        self.process(self._rxmv[:n])
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import threading, time, json, os
-from datetime import datetime
-from flask import Flask, render_template_string, request, redirect, jsonify
+import threading, time, json, os, atexit, queue
+from datetime import datetime, timedelta
+from flask import Flask, request, redirect, jsonify, Response
 from gpiozero import DigitalOutputDevice, DigitalInputDevice
+from waitress import serve
 import BlynkLib
 
 # ---------------- CONFIG ----------------
@@ -11,11 +12,14 @@ VERSION = "GateController v5.0"
 BLYNK_AUTH_TOKEN = 'xxxxyyyyyzzzz'
 RELAY_PIN = 21
 REED_PIN = 20
+REED_BOUNCE_TIME = 0.05  # seconds the reed must be quiet before its state is read
 SCHEDULE_FILE = "schedule.json"
 LOG_FILE = "gate_log.txt"
 RELAY_DURATION = 1.0  # seconds
 RECONNECT_INTERVAL = 30  # seconds
 BLYNK_KEEPALIVE_INTERVAL = 5  # seconds
+STATUS_CACHE_TTL = 0.5  # seconds
+SCHEDULE_MAX_SLEEP = 60  # seconds, re-check the wall clock (no RTC, NTP may step it)
 
 # ---------------- HARDWARE ----------------
 relay = DigitalOutputDevice(RELAY_PIN, active_high=False, initial_value=True)  # HIGH=OFF
@@ -33,12 +37,26 @@ if os.path.exists(SCHEDULE_FILE):
     with open(SCHEDULE_FILE, "r") as f:
         schedule.update(json.load(f))
 
+# (open, close) as datetime.time, None while unparseable; replaced in one
+# assignment so schedule_worker never sees a half-updated pair
+_parsed = {"times": None}
+
+def parse_schedule():
+    try:
+        open_t = datetime.strptime(schedule["open_time"], "%H:%M").time()
+        close_t = datetime.strptime(schedule["close_time"], "%H:%M").time()
+    except ValueError:
+        _parsed["times"] = None
+        raise
+    _parsed["times"] = (open_t, close_t)
+
 # ---------------- INITIALIZE last_triggered ----------------
 now = datetime.now()
 today = now.date()
 try:
-    open_dt = datetime.combine(today, datetime.strptime(schedule["open_time"], "%H:%M").time())
-    close_dt = datetime.combine(today, datetime.strptime(schedule["close_time"], "%H:%M").time())
+    parse_schedule()
+    open_dt = datetime.combine(today, _parsed["times"][0])
+    close_dt = datetime.combine(today, _parsed["times"][1])
 except Exception:
     open_dt = close_dt = None
 
@@ -46,30 +64,107 @@ last_triggered = {
     "open": open_dt if now >= open_dt else None,
     "close": close_dt if now >= close_dt else None
 }
+schedule_changed = threading.Event()  # wakes schedule_worker after a web edit
+
+# ---------------- STATUS CACHE ----------------
+_status_cache = {"ts": 0.0, "etag": None, "body": None}  # serialized /status, shared by all pollers
+
+def invalidate_status():
+    _status_cache["ts"] = 0.0
 
 # ---------------- SAFE BLYNK WRITE ----------------
-def safe_blynk_write(pin, value):
+_last_pushed = {}  # pin -> last value sent, cleared on (re)connect
+
+def safe_blynk_write(pin, value, force=False):
+    if not force and _last_pushed.get(pin) == value:
+        return
     try:
         if blynk_connected_flag:
             blynk.virtual_write(pin, value)
+            _last_pushed[pin] = value
     except (BrokenPipeError, ConnectionResetError, AttributeError, OSError) as e:
         print(f"[BLYNK WRITE ERROR] Pin {pin} Value {value}: {e}")
 
+def safe_blynk_write_many(pairs):
+    pairs = [(pin, value) for pin, value in pairs if _last_pushed.get(pin) != value]
+    if not pairs:
+        return
+    try:
+        if blynk_connected_flag:
+            blynk.virtual_write_many(pairs)
+            _last_pushed.update(pairs)
+    except (BrokenPipeError, ConnectionResetError, AttributeError, OSError) as e:
+        print(f"[BLYNK WRITE ERROR] Pins {pairs}: {e}")
+
 # ---------------- LOG ----------------
+# Lines are written by a single thread so slow flash never stalls GPIO/relay callers
+def _open_log():
+    return os.open(LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+_log_fd = _open_log()
+log_q = queue.Queue(maxsize=1000)
+
+def _log_replaced():
+    # True once LOG_FILE was rotated or deleted and _log_fd points at the old file
+    try:
+        st = os.stat(LOG_FILE)
+    except FileNotFoundError:
+        return True
+    fst = os.fstat(_log_fd)
+    return (st.st_ino, st.st_dev) != (fst.st_ino, fst.st_dev)
+
+def _log_writer():
+    global _log_fd
+    while True:
+        line = log_q.get()
+        if line is None:
+            break
+        try:
+            if _log_replaced():
+                new_fd = _open_log()  # keep the old fd if this fails
+                os.close(_log_fd)
+                _log_fd = new_fd
+            os.write(_log_fd, line.encode())
+        except OSError as e:  # e.g. ENOSPC on a full SD card, keep draining
+            print(f"[LOG WRITE ERROR] {e}")
+    os.close(_log_fd)
+
+_log_thread = threading.Thread(target=_log_writer, daemon=True)
+_log_thread.start()
+
+def _stop_log_writer():
+    if not _log_thread.is_alive():
+        return
+    try:
+        log_q.put(None, timeout=1)
+    except queue.Full:
+        return  # writer is stuck, don't hang shutdown on it
+    _log_thread.join(timeout=2)
+
+atexit.register(_stop_log_writer)
+
 def log(msg, push=True):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     line = f"{timestamp} - {msg}"
     print(line)
-    with open(LOG_FILE, "a") as f:
-        f.write(line + "\n")
+    try:
+        log_q.put_nowait(line + "\n")
+    except queue.Full:
+        pass  # writer is behind, line still went to stdout/journal
     if push:
-        safe_blynk_write(2, 1 if not relay.value else 0)
+        push_status()
+
+LOG_TAIL_BYTES = 4096  # enough for the last few lines, independent of log size
 
 def get_last_logs(n=10):
     if not os.path.exists(LOG_FILE):
         return ""
-    with open(LOG_FILE) as f:
-        lines = f.readlines()
+    size = os.path.getsize(LOG_FILE)
+    with open(LOG_FILE, "rb") as f:
+        f.seek(max(0, size - LOG_TAIL_BYTES))
+        lines = f.read().decode("utf-8", "replace").splitlines(keepends=True)
+    if size > LOG_TAIL_BYTES:
+        lines = lines[1:]  # first line is probably cut mid-way
     return "".join(lines[-n:])
 
 # ---------------- GATE CONTROL ----------------
@@ -78,47 +173,52 @@ def is_gate_open():
 
 _last_reed_state = is_gate_open()
 
-def push_reed_status():
-    global _last_reed_state
-    current = is_gate_open()
-    if current != _last_reed_state:
-        safe_blynk_write(3, 1 if current else 0)
-        safe_blynk_write(22, 0 if current else 1)
-        _last_reed_state = current
-
-def push_relay_status():
-    safe_blynk_write(2, 1 if not relay.value else 0)
-
 def push_status():
-    push_relay_status()
-    push_reed_status()
+    # One frame batch for relay + reed pins; unchanged pins are skipped by the cache
+    current = is_gate_open()
+    safe_blynk_write_many([(2, 1 if not relay.value else 0),
+                           (3, 1 if current else 0),
+                           (22, 0 if current else 1)])
 
 def pulse_relay(duration=RELAY_DURATION):
-    with relay_lock:
-        log(">>> RELAY ON (pulse start)")
+    # A pulse already running wins; don't park another thread behind it
+    if not relay_lock.acquire(blocking=False):
+        log("Relay busy, pulse skipped", push=False)
+        return False
+    try:
+        log(">>> RELAY ON (pulse start)", push=False)
         relay.off()  # LOW=ON
-        safe_blynk_write(2, 1)
+        invalidate_status()
+        push_status()
         time.sleep(duration)
         relay.on()   # HIGH=OFF
-        log("<<< RELAY OFF (pulse end)")
-        safe_blynk_write(2, 0)
+        invalidate_status()
+        log("<<< RELAY OFF (pulse end)", push=False)
+        push_status()
+    finally:
+        relay_lock.release()
     time.sleep(0.2)
+    return True
 
 def open_gate(trigger="manual"):
+    done = True  # False only if the relay was busy with another pulse
     if not is_gate_open():
         log(f"Gate OPEN triggered by {trigger}")
-        pulse_relay()
+        done = pulse_relay()
     else:
         log(f"Gate OPEN skipped (already open) [{trigger}]")
-    push_relay_status()
+    push_status()
+    return done
 
 def close_gate(trigger="manual"):
+    done = True  # False only if the relay was busy with another pulse
     if is_gate_open():
         log(f"Gate CLOSE triggered by {trigger}")
-        pulse_relay()
+        done = pulse_relay()
     else:
         log(f"Gate CLOSE skipped (already closed) [{trigger}]")
-    push_relay_status()
+    push_status()
+    return done
 
 # ---------------- REED CHANGE HANDLER ----------------
 def reed_changed():
@@ -126,9 +226,9 @@ def reed_changed():
     current = is_gate_open()
     if current == _last_reed_state:
         return
+    invalidate_status()
 
-    safe_blynk_write(3, 1 if current else 0)
-    safe_blynk_write(22, 0 if current else 1)
+    push_status()
 
     try:
         if current:
@@ -141,8 +241,29 @@ def reed_changed():
     _last_reed_state = current
     log(f"Reed state changed: {'OPEN' if current else 'CLOSED'}", push=False)
 
-reed.when_activated = reed_changed
-reed.when_deactivated = reed_changed
+# Trailing-edge debounce: edges only stamp the time, reed_settle_worker calls
+# reed_changed once the contacts have been quiet, so the settled value is read
+_reed_edge_ts = 0.0
+_reed_edge = threading.Event()
+
+def reed_edge():
+    global _reed_edge_ts
+    _reed_edge_ts = time.monotonic()
+    _reed_edge.set()
+
+def reed_settle_worker():
+    while True:
+        _reed_edge.wait()
+        while True:
+            _reed_edge.clear()  # edges after this will trigger another pass
+            quiet = time.monotonic() - _reed_edge_ts
+            if quiet >= REED_BOUNCE_TIME:
+                break
+            time.sleep(REED_BOUNCE_TIME - quiet)
+        reed_changed()
+
+reed.when_activated = reed_edge
+reed.when_deactivated = reed_edge
 
 # ---------------- BLYNK HANDLERS ----------------
 @blynk.on("V1")
@@ -157,7 +278,8 @@ def handle_blynk_control(value):
 def blynk_connected():
     global blynk_connected_flag
     blynk_connected_flag = True
-    log("Raspberry Pi Connected to Blynk", push=False)
+    _last_pushed.clear()
+    log("Raspberry Pi Connected to Blynk")  # push resyncs every status pin
 
 @blynk.on("disconnected")
 def blynk_disconnected():
@@ -168,9 +290,8 @@ def blynk_disconnected():
 # ---------------- FLASK ----------------
 app = Flask(__name__)
 
-@app.route("/")
-def index():
-    return render_template_string("""
+# Compiled once at import; only rendering happens per request
+INDEX_TEMPLATE = app.jinja_env.from_string("""
     <!doctype html>
     <html>
     <head>
@@ -230,38 +351,68 @@ def index():
                 document.getElementById('blynk_status').style.color = data.blynk ? "green" : "red";
 
                 document.getElementById('log').innerText = data.log;
-                document.getElementById('now_time').innerHTML = data.current_time;
 
                 document.getElementById('open_btn').className = data.gate ? "btn btn-secondary btn-lg rounded-pill flex-fill" : "btn btn-success btn-lg rounded-pill flex-fill";
                 document.getElementById('close_btn').className = data.gate ? "btn btn-danger btn-lg rounded-pill flex-fill" : "btn btn-secondary btn-lg rounded-pill flex-fill";
             });
         }
         setInterval(fetchStatus, 2000);
+
+        // /status may answer 304 with a cached body, so the Pi clock ticks locally
+        const clockOffset = {{clock_ms}} - Date.now();
+        function tickClock() {
+            const t = new Date(Date.now() + clockOffset).toISOString();
+            document.getElementById('now_time').innerHTML = t.slice(0, 10) + " " + t.slice(11, 19);
+        }
+        setInterval(tickClock, 1000);
         </script>
     </body>
     </html>
-    """, version=VERSION, now_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    """)
+
+@app.route("/")
+def index():
+    now = datetime.now()
+    return INDEX_TEMPLATE.render(version=VERSION, now_time=now.strftime("%Y-%m-%d %H:%M:%S"),
+       clock_ms=int((now - datetime(1970, 1, 1)).total_seconds() * 1000),  # local time as if UTC
        gate=is_gate_open(), relay=not relay.value, blynk=blynk_connected_flag,
        schedule=schedule, log_content=get_last_logs(10))
 
 @app.route("/status")
 def status():
-    return jsonify({
-        "gate": is_gate_open(),
-        "relay": not relay.value,
-        "blynk": blynk_connected_flag,
-        "log": get_last_logs(10),
-        "current_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
+    now_ts = time.monotonic()
+    if now_ts - _status_cache["ts"] >= STATUS_CACHE_TTL:
+        gate, relay_on, blynk_on = is_gate_open(), not relay.value, blynk_connected_flag
+        try:
+            st = os.stat(LOG_FILE)
+            log_mtime, log_size = st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            log_mtime = log_size = 0  # rotated or cleared, page keeps polling
+        etag = f'"{gate:d}{relay_on:d}{blynk_on:d}-{log_mtime:x}-{log_size:x}"'
+        if etag != _status_cache["etag"]:
+            body = json.dumps({"gate": gate, "relay": relay_on, "blynk": blynk_on,
+                               "log": get_last_logs(10)})
+            _status_cache.update(etag=etag, body=body)
+        _status_cache["ts"] = now_ts
+    etag = _status_cache["etag"]
+    if request.headers.get("If-None-Match") == etag:
+        resp = Response(status=304)
+    else:
+        resp = Response(_status_cache["body"], mimetype="application/json")
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = "no-cache"  # always revalidate, never serve blind
+    return resp
 
 @app.route("/open", methods=["POST"])
 def web_open():
-    open_gate(trigger="Web")
+    if not open_gate(trigger="Web"):
+        return jsonify({"error": "relay busy"}), 409
     return redirect("/")
 
 @app.route("/close", methods=["POST"])
 def web_close():
-    close_gate(trigger="Web")
+    if not close_gate(trigger="Web"):
+        return jsonify({"error": "relay busy"}), 409
     return redirect("/")
 
 @app.route("/schedule", methods=["POST"])
@@ -271,6 +422,11 @@ def web_schedule():
     schedule["close_time"] = request.form.get("close_time", schedule["close_time"])
     with open(SCHEDULE_FILE, "w") as f:
         json.dump(schedule, f)
+    try:
+        parse_schedule()
+    except ValueError as e:
+        log(f"Schedule parse error: {e}")
+    schedule_changed.set()
     log("Schedule updated via Web")
     return redirect("/")
 
@@ -278,23 +434,29 @@ def web_schedule():
 def schedule_worker():
     global last_triggered
     while True:
-        if schedule["enabled"]:
-            now = datetime.now()
-            today = now.date()
-            try:
-                open_dt = datetime.combine(today, datetime.strptime(schedule["open_time"], "%H:%M").time())
-                close_dt = datetime.combine(today, datetime.strptime(schedule["close_time"], "%H:%M").time())
-            except Exception as e:
-                log(f"Schedule parse error: {e}")
-                time.sleep(5)
-                continue
-            if now >= open_dt and last_triggered["open"] != open_dt:
-                open_gate(trigger="Schedule")
-                last_triggered["open"] = open_dt
-            if now >= close_dt and last_triggered["close"] != close_dt:
-                close_gate(trigger="Schedule")
-                last_triggered["close"] = close_dt
-        time.sleep(2)
+        schedule_changed.clear()
+        if not schedule["enabled"]:
+            schedule_changed.wait()
+            continue
+        now = datetime.now()
+        today = now.date()
+        times = _parsed["times"]  # read once, web_schedule may swap it meanwhile
+        if times is None:
+            # Unparseable times were logged by parse_schedule's caller
+            schedule_changed.wait()
+            continue
+        open_dt = datetime.combine(today, times[0])
+        close_dt = datetime.combine(today, times[1])
+        if now >= open_dt and last_triggered["open"] != open_dt:
+            open_gate(trigger="Schedule")
+            last_triggered["open"] = open_dt
+        if now >= close_dt and last_triggered["close"] != close_dt:
+            close_gate(trigger="Schedule")
+            last_triggered["close"] = close_dt
+        # Sleep until the next trigger is due (today's if still ahead, else tomorrow's)
+        target = min(dt if dt > now else dt + timedelta(days=1) for dt in (open_dt, close_dt))
+        delay = (target - datetime.now()).total_seconds()
+        schedule_changed.wait(min(SCHEDULE_MAX_SLEEP, max(1, delay)))
 
 def blynk_loop():
     global last_reconnect, blynk_connected_flag
@@ -317,18 +479,19 @@ def blynk_loop():
 def blynk_keepalive_worker():
     while True:
         if blynk_connected_flag:
-            safe_blynk_write(99, 0)  # keep alive
+            safe_blynk_write(99, 0, force=True)  # keep alive
         time.sleep(BLYNK_KEEPALIVE_INTERVAL)
 
 # ---------------- START THREADS ----------------
 threading.Thread(target=blynk_loop, daemon=True).start()
 threading.Thread(target=schedule_worker, daemon=True).start()
 threading.Thread(target=blynk_keepalive_worker, daemon=True).start()
+threading.Thread(target=reed_settle_worker, daemon=True).start()
 
 # ---------------- RUN FLASK ----------------
 if __name__ == "__main__":
     log(f"Starting Pi Gate Controller (Flask + Blynk) - {VERSION}")
     try:
-        app.run(host="0.0.0.0", port=5000, threaded=True)
+        serve(app, host="0.0.0.0", port=5000, threads=4, connection_limit=50, channel_timeout=30)
     finally:
         relay.on()